@@ -11,7 +11,7 @@ async function dailyRecommendTask() {
   await collectRecommendDataForAllStores();
 
   console.log("🕑 Retraining ML model...");
-  exec("python ml/train_recommend_model.py", (err, stdout, stderr) => {
+  exec("python ml/train_recommend_model.py --incremental", (err, stdout, stderr) => {
     if (err) return console.error("❌ Error retraining model:", err);
     if (stderr) console.error("Python stderr:", stderr);
     console.log(stdout);
@@ -1,60 +1,332 @@
 import os
+import sys
 import json
+import time
+import shutil
+import hashlib
+import argparse
+import tempfile
+import subprocess
+import numpy as np
 import pandas as pd
 from sklearn.ensemble import RandomForestRegressor
+from sklearn.metrics import mean_absolute_error, r2_score
 import pickle
 from itertools import combinations
 
-# --- Load dữ liệu từ tất cả quán ---
 folder_path = "ml/recommendDishDataset"
-all_rows = []
-
-for filename in os.listdir(folder_path):
-    if filename.endswith(".json"):
-        file_path = os.path.join(folder_path, filename)
-        with open(file_path, "r", encoding="utf-8") as f:
-            data = json.load(f)
-            all_rows.extend(data)
-
-df = pd.DataFrame(all_rows)
-print("[OK] Loaded", len(df), "rows from", folder_path)
-
-# --- Tiền xử lý ---
-df = df.dropna(subset=[
-    "totalRevenue",
-    "totalSold",
-    "totalIngredientStock",
-    "totalIngredientWaste",
-    "ingredientCount",
-    "toppingCount",
-    "ingredients"
-])
-
-# --- Tạo danh sách tất cả nguyên liệu ---
-all_ingredients = sorted(list({ing for sublist in df['ingredients'] for ing in sublist}))
-print("[INFO] All ingredients:", all_ingredients)
-
-# --- One-hot encode nguyên liệu ---
-for ing in all_ingredients:
-    df[f"ing_{ing}"] = df['ingredients'].apply(lambda x: 1 if ing in x else 0)
-
-# --- Feature và target ---
-feature_cols = ["totalSold", "totalIngredientStock", "totalIngredientWaste", "ingredientCount", "toppingCount"] + [f"ing_{i}" for i in all_ingredients]
-X = df[feature_cols]
-y = df["totalRevenue"]
-
-# --- Huấn luyện model ---
-model = RandomForestRegressor(n_estimators=200, random_state=42)
-model.fit(X, y)
-
-# --- Lưu model và danh sách nguyên liệu ---
-os.makedirs("ml", exist_ok=True)
 model_path = "ml/recommendDishModel.pkl"
-with open(model_path, "wb") as f:
-    pickle.dump({
-        "model": model,
-        "ingredients": all_ingredients,
-        "feature_cols": feature_cols
-    }, f)
-
-print(f"✅ Model trained and saved to {model_path}")
+report_path = "ml/recommendDishModel.report.json"
+
+N_ESTIMATORS = 200
+# Số cây thay mới mỗi lần train incremental -> forest phủ N_ESTIMATORS / INCREMENTAL_TREES lần chạy gần nhất.
+# Lưu ý: recommendDataCollector ghi lại toàn bộ file mỗi đêm với doanh thu/số lượng tính từ đầu tháng và tồn kho
+# hiện tại, nên hầu hết món có bán trong ngày đều bị coi là "thay đổi". Cây cũ giữ snapshot cũ của cùng món
+# (kể cả snapshot tháng trước khi sang tháng mới tổng bị reset, hay món/quán đã bị xóa) cho tới khi bị loại khỏi cửa sổ.
+INCREMENTAL_TREES = 20
+# Model tham chiếu (oob_score) để ước lượng full retrain, chỉ chạy mỗi REPORT_EVERY lần incremental cho đỡ tốn
+REPORT_ESTIMATORS = 50
+REPORT_EVERY = 7
+RANDOM_STATE = 42
+
+base_cols = ["totalSold", "totalIngredientStock", "totalIngredientWaste", "ingredientCount", "toppingCount"]
+required_cols = ["totalRevenue"] + base_cols + ["ingredients"]
+
+
+def row_hash(row):
+    # Chỉ hash feature/target, đổi tên món hay nhóm món không tính là thay đổi
+    payload = {c: row.get(c) for c in ["dishId"] + required_cols}
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+# --- Load dữ liệu từ tất cả quán ---
+def load_dataset(folder=folder_path):
+    all_rows = []
+
+    for filename in sorted(os.listdir(folder)):
+        if filename.endswith(".json"):
+            file_path = os.path.join(folder, filename)
+            with open(file_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+
+            for row in data:
+                all_rows.append({**row, "rowKey": f"{filename}:{row.get('dishId')}", "rowHash": row_hash(row)})
+
+    return all_rows
+
+
+# --- Tiền xử lý + one-hot encode nguyên liệu ---
+def build_frame(rows, all_ingredients):
+    df = pd.DataFrame(rows) if rows else pd.DataFrame(columns=required_cols + ["rowKey", "rowHash"])
+    df = df.dropna(subset=required_cols)
+
+    for ing in all_ingredients:
+        df[f"ing_{ing}"] = df["ingredients"].apply(lambda x: 1 if ing in x else 0)
+
+    return df
+
+
+def get_vocabulary(df):
+    return sorted(list({ing for sublist in df["ingredients"] for ing in sublist}))
+
+
+def get_feature_cols(all_ingredients):
+    return base_cols + [f"ing_{i}" for i in all_ingredients]
+
+
+def load_artifact(path=model_path):
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        return pickle.load(f)
+
+
+def save_artifact(model, all_ingredients, feature_cols, df, mode, incremental_runs, path=model_path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        pickle.dump({
+            "model": model,
+            "ingredients": all_ingredients,
+            "feature_cols": feature_cols,
+            "row_hashes": dict(zip(df["rowKey"], df["rowHash"])),
+            "mode": mode,
+            "incremental_runs": incremental_runs,
+            "trained_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        }, f)
+
+
+# --- Huấn luyện lại toàn bộ model ---
+def train_full(X, y, n_estimators=N_ESTIMATORS, oob_score=False):
+    model = RandomForestRegressor(n_estimators=n_estimators, random_state=RANDOM_STATE, oob_score=oob_score)
+    model.fit(X, y)
+    return model
+
+
+# --- Thêm cây mới trên dữ liệu vừa thay đổi, bỏ các cây cũ nhất ---
+def train_incremental(model, X_changed, y_changed, incremental_runs, n_new=INCREMENTAL_TREES):
+    n_old = len(model.estimators_)
+    # Seed theo số lần chạy incremental để cây mới không lặp lại bootstrap của lần trước mà vẫn tái lập được
+    model.set_params(warm_start=True, n_estimators=n_old + n_new, random_state=RANDOM_STATE + incremental_runs)
+    model.fit(X_changed, y_changed)
+
+    # warm_start nối cây mới vào cuối -> cây cũ nhất nằm đầu danh sách
+    n_retire = max(0, len(model.estimators_) - N_ESTIMATORS)
+    model.estimators_ = model.estimators_[n_retire:]
+    model.set_params(warm_start=False, n_estimators=len(model.estimators_))
+    return model, n_retire
+
+
+def score(y_true, pred):
+    return {
+        "mae": round(float(mean_absolute_error(y_true, pred)), 4),
+        "r2": round(float(r2_score(y_true, pred)), 4) if len(y_true) > 1 else None,
+    }
+
+
+# --- Báo cáo: cây mới vs full retrain, chỉ chấm trên dữ liệu mà mỗi bên chưa fit ---
+def build_report(model, df, df_changed, feature_cols, n_retire, removed_rows, train_seconds, with_reference):
+    # Cây mới chỉ fit trên df_changed -> các dòng không đổi là dữ liệu chúng chưa thấy
+    df_eval = df.drop(df_changed.index)
+
+    report = {
+        "generatedAt": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "changedRows": int(len(df_changed)),
+        "removedRows": removed_rows,
+        "evalRows": int(len(df_eval)),
+        "treesAdded": INCREMENTAL_TREES,
+        "treesRetired": n_retire,
+        "newTrees": {"mae": None, "r2": None, "trainSeconds": round(train_seconds, 3)},
+        "fullRetrainOob": None,
+        "meanAbsPredictionGap": None,
+    }
+
+    pred_new = None
+    if not df_eval.empty:
+        new_trees = model.estimators_[-INCREMENTAL_TREES:]
+        X_eval = df_eval[feature_cols].to_numpy(dtype=np.float32)
+        pred_new = np.mean([tree.predict(X_eval) for tree in new_trees], axis=0)
+        report["newTrees"].update(score(df_eval["totalRevenue"], pred_new))
+
+    if not with_reference or len(df) < 2:
+        return report
+
+    # Tham chiếu full retrain trên toàn bộ dữ liệu, chấm bằng out-of-bag nên không bị in-sample
+    start = time.time()
+    reference = train_full(df[feature_cols], df["totalRevenue"], n_estimators=REPORT_ESTIMATORS, oob_score=True)
+    reference_seconds = time.time() - start
+    oob = pd.Series(reference.oob_prediction_, index=df.index)
+
+    report["fullRetrainOob"] = {
+        **score(df["totalRevenue"], oob),
+        "trees": REPORT_ESTIMATORS,
+        "estimatedFullRetrainSeconds": round(reference_seconds * N_ESTIMATORS / REPORT_ESTIMATORS, 3),
+    }
+    if pred_new is not None:
+        report["meanAbsPredictionGap"] = round(float(np.abs(pred_new - oob.loc[df_eval.index].to_numpy()).mean()), 4)
+
+    return report
+
+
+def run_full(df, all_ingredients, feature_cols, path=model_path):
+    model = train_full(df[feature_cols], df["totalRevenue"])
+    save_artifact(model, all_ingredients, feature_cols, df, "full", 0, path=path)
+    print(f"✅ Model trained and saved to {path}")
+    return model
+
+
+def run_incremental(df, all_ingredients, feature_cols, path=model_path, report_file=report_path):
+    artifact = load_artifact(path)
+
+    # Chỉ rebuild toàn bộ khi chưa có model, hoặc từ vựng nguyên liệu / schema feature thay đổi
+    if artifact is None or "row_hashes" not in artifact:
+        print("[INFO] No incremental artifact found, falling back to full rebuild")
+        return run_full(df, all_ingredients, feature_cols, path=path), None
+    if artifact["ingredients"] != all_ingredients:
+        print("[INFO] Ingredient vocabulary changed, falling back to full rebuild")
+        return run_full(df, all_ingredients, feature_cols, path=path), None
+    if artifact["feature_cols"] != feature_cols:
+        print("[INFO] Feature schema changed, falling back to full rebuild")
+        return run_full(df, all_ingredients, feature_cols, path=path), None
+
+    # Món/quán bị xóa không rebuild, chỉ đợi các cây đã học chúng bị loại khỏi cửa sổ
+    previous_hashes = artifact["row_hashes"]
+    removed_rows = len(set(previous_hashes) - set(df["rowKey"]))
+    df_changed = df[df["rowKey"].map(previous_hashes) != df["rowHash"]]
+
+    if df_changed.empty:
+        print("[INFO] No changed data since last training, model kept as is")
+        return artifact["model"], None
+
+    print("[INFO] Changed rows:", len(df_changed), "of", len(df))
+
+    incremental_runs = artifact.get("incremental_runs", 0) + 1
+    start = time.time()
+    model, n_retire = train_incremental(
+        artifact["model"], df_changed[feature_cols], df_changed["totalRevenue"], incremental_runs
+    )
+    train_seconds = time.time() - start
+
+    save_artifact(model, all_ingredients, feature_cols, df, "incremental", incremental_runs, path=path)
+    print(f"✅ Model updated incrementally (+{INCREMENTAL_TREES}/-{n_retire} trees) and saved to {path}")
+
+    report = build_report(
+        model, df, df_changed, feature_cols, n_retire, removed_rows, train_seconds,
+        with_reference=incremental_runs % REPORT_EVERY == 1,
+    )
+    with open(report_file, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"[INFO] Validation report saved to {report_file}")
+    print(json.dumps(report))
+    return model, report
+
+
+def prepare(folder=folder_path):
+    all_rows = load_dataset(folder)
+    print("[OK] Loaded", len(all_rows), "rows from", folder)
+
+    # --- Tạo danh sách tất cả nguyên liệu ---
+    df = build_frame(all_rows, [])
+    all_ingredients = get_vocabulary(df)
+    print("[INFO] All ingredients:", all_ingredients)
+
+    df = build_frame(all_rows, all_ingredients)
+    return df, all_ingredients, get_feature_cols(all_ingredients)
+
+
+# --- Kiểm tra nhanh luồng warm-start/retire trên dữ liệu giả trong thư mục tạm ---
+def self_check():
+    def make_rows(store, revenue_offset):
+        return [{
+            "dishId": f"{store}-{i}",
+            "name": f"Dish {i}",
+            "ingredientCount": 2,
+            "toppingCount": i % 3,
+            "totalRevenue": 1000 * i + revenue_offset,
+            "totalSold": 10 * i,
+            "totalIngredientStock": 50 + i,
+            "totalIngredientWaste": i % 4,
+            "ingredients": ["beef", "rice"] if i % 2 else ["chicken", "rice"],
+        } for i in range(1, 13)]
+
+    def write_store(folder, store, rows):
+        with open(os.path.join(folder, f"store_{store}.json"), "w", encoding="utf-8") as f:
+            json.dump(rows, f)
+
+    tmp = tempfile.mkdtemp()
+    try:
+        folder = os.path.join(tmp, "ml", "recommendDishDataset")
+        path = os.path.join(tmp, "ml", "recommendDishModel.pkl")
+        report_file = os.path.join(tmp, "ml", "recommendDishModel.report.json")
+        os.makedirs(folder)
+        write_store(folder, "a", make_rows("a", 0))
+        write_store(folder, "b", make_rows("b", 0))
+
+        df, all_ingredients, feature_cols = prepare(folder)
+        old_model = run_full(df, all_ingredients, feature_cols, path=path)
+        old_seeds = [tree.random_state for tree in old_model.estimators_]
+
+        # Đổi tên món không được tính là thay đổi
+        renamed = make_rows("a", 0)
+        renamed[0]["name"] = "Renamed"
+        write_store(folder, "a", renamed)
+        df, all_ingredients, feature_cols = prepare(folder)
+        _, report = run_incremental(df, all_ingredients, feature_cols, path=path, report_file=report_file)
+        assert report is None, "renaming a dish must not trigger new trees"
+
+        # Đổi doanh thu một quán -> thêm cây mới, bỏ cây cũ nhất
+        write_store(folder, "a", make_rows("a", 500))
+        df, all_ingredients, feature_cols = prepare(folder)
+        model, report = run_incremental(df, all_ingredients, feature_cols, path=path, report_file=report_file)
+        seeds = [tree.random_state for tree in model.estimators_]
+        assert len(model.estimators_) == N_ESTIMATORS, "forest must stay at N_ESTIMATORS trees"
+        assert seeds[:-INCREMENTAL_TREES] == old_seeds[INCREMENTAL_TREES:], "oldest trees must be retired"
+        assert report["newTrees"]["mae"] is not None and report["fullRetrainOob"] is not None
+
+        # Model đã pickle vẫn dự đoán được qua predictRevenue.py
+        shutil.copy(os.path.join(os.path.dirname(os.path.abspath(__file__)), "predictRevenue.py"), tmp)
+        features = {c: 1 for c in base_cols}
+        features["ingredients"] = ["beef", "rice"]
+        out = subprocess.run(
+            [sys.executable, "predictRevenue.py", json.dumps(features)], cwd=tmp, capture_output=True, text=True, check=True
+        )
+        assert "predictedRevenue" in json.loads(out.stdout)
+
+        # Mọi dòng đều đổi -> không có dòng để chấm cây mới, báo cáo vẫn phải ghi được
+        write_store(folder, "a", make_rows("a", 900))
+        write_store(folder, "b", make_rows("b", 900))
+        df, all_ingredients, feature_cols = prepare(folder)
+        _, report = run_incremental(df, all_ingredients, feature_cols, path=path, report_file=report_file)
+        assert report["evalRows"] == 0 and report["newTrees"]["mae"] is None
+        assert os.path.exists(report_file)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    print("✅ Self-check passed")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Train recommend dish model")
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="warm-start from the previous model and only fit new trees on changed dish rows",
+    )
+    parser.add_argument(
+        "--self-check",
+        action="store_true",
+        help="run the warm-start/retire path on synthetic data in a temporary folder",
+    )
+    args = parser.parse_args()
+
+    if args.self_check:
+        return self_check()
+
+    df, all_ingredients, feature_cols = prepare()
+    if args.incremental:
+        run_incremental(df, all_ingredients, feature_cols)
+    else:
+        run_full(df, all_ingredients, feature_cols)
+
+
+if __name__ == "__main__":
+    sys.exit(main())